@@ -1,43 +1,116 @@
 import argparse
-import json
-from typing import List
-
+import re
+from multiprocessing import Pool
+from multiprocessing.shared_memory import SharedMemory
+from typing import FrozenSet, List, Optional, Tuple
+
+# The pure python backend keeps lone surrogates, which the C backend silently replaces with '?'
+import ijson.backends.python as ijson
+import numpy as np
+import orjson
 from fontTools.ttLib import TTFont
 
 from scraper import LetterboxdReview
 
+MAX_WORDS = 100
+WORD_RE = re.compile(r'\S+')
+CHUNK_SIZE = 512
+
+# Sorted renderable codepoints, shared with each worker process by init_worker
+_SHARED: Optional[SharedMemory] = None
+_SUPPORTED: np.ndarray = np.empty(0, dtype=np.uint32)
+
+
+def supported_codepoints(fonts: List[TTFont]) -> FrozenSet[int]:
+    """
+    Collects every unicode codepoint that can be rendered by at least one of a list of fonts.
+    Based on https://stackoverflow.com/questions/43834362/python-unicode-rendering-how-to-know-if-a-unicode-character-is-missing-from-the
+    :param fonts: the fonts to check
+    :return: the set of codepoints contained in the unicode cmap tables of the fonts
+    """
+    supported = set()
+    for font in fonts:
+        for cmap in font['cmap'].tables:
+            if cmap.isUnicode():
+                supported.update(cmap.cmap.keys())
+    return frozenset(supported)
+
+
+def share_codepoints(supported: FrozenSet[int]) -> Tuple[SharedMemory, int]:
+    """
+    Stores renderable codepoints (and newlines) in shared memory as a sorted array, so worker processes can read
+    them without each receiving a copy.
+    :param supported: the codepoints renderable by the chosen fonts
+    :return: the shared memory block containing the array, which the caller must close and unlink, and the
+             number of codepoints in the array
+    """
+    codepoints = np.sort(np.fromiter(supported | {ord('\n')}, dtype=np.uint32))
+
+    shm = SharedMemory(create=True, size=codepoints.nbytes)
+    np.ndarray(codepoints.shape, dtype=np.uint32, buffer=shm.buf)[:] = codepoints
+    return shm, len(codepoints)
+
 
-def char_not_in_font(unicode_char: str, font: TTFont) -> bool:
+def exceeds_word_limit(text: str, limit: int) -> bool:
     """
-    Checks whether a unicode character is not in a font.
-    From https://stackoverflow.com/questions/43834362/python-unicode-rendering-how-to-know-if-a-unicode-character-is-missing-from-the
-    :param unicode_char: the unicode character
-    :param font: the font to check
-    :return: True if `unicode_char` is not in font, otherwise False
+    Checks whether a piece of text contains more than a given number of words, stopping as soon as the limit is passed.
+    :param text: the text to check
+    :param limit: the maximum number of words allowed
+    :return: True if `text` contains more than `limit` words, otherwise False
     """
-    for cmap in font['cmap'].tables:
-        if cmap.isUnicode():
-            if ord(unicode_char) in cmap.cmap:
-                return False
-    return True
+    for count, _ in enumerate(WORD_RE.finditer(text), 1):
+        if count > limit:
+            return True
+    return False
 
 
-def should_include(review: LetterboxdReview, fonts: List[TTFont]) -> bool:
+def should_include(review: LetterboxdReview, supported: np.ndarray) -> bool:
     """
     Checks whether a letterboxd review should be included in the clean set.
     Reviews must be 100 words or less, and must be renderable by the chosen font
     :param review: the review to check
-    :param fonts: the fonts which will be used to render the review
+    :param supported: a sorted array of the codepoints renderable by the fonts which will be used to render the
+                      review (and newlines)
     :return: True if review should be included in the clean set, otherwise False
     """
-    if len(review['text'].split()) > 100:
+    text = review['text']
+    # Every word needs a separator, so short texts can't be over the limit and don't need counting
+    if len(text) > 2 * MAX_WORDS and exceeds_word_limit(text, MAX_WORDS):
         return False
 
-    for char in review['text']:
-        if char != '\n' and all(char_not_in_font(char, font) for font in fonts):
-            return False
+    # Look up every character of the review at once
+    try:
+        codepoints = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
+    except UnicodeEncodeError:
+        # Lone surrogates can't be rendered
+        return False
+    idx = np.searchsorted(supported, codepoints)
+    return bool(np.all(supported.take(idx, mode='clip') == codepoints))
+
+
+def init_worker(shm_name: str, size: int) -> None:
+    """
+    Initialises a worker process with the codepoints supported by the chosen fonts.
+    :param shm_name: the name of the shared memory block created by share_codepoints
+    :param size: the number of codepoints in the shared array
+    """
+    global _SHARED, _SUPPORTED
+    # Keep a reference to the block, so the array's buffer stays valid
+    _SHARED = SharedMemory(name=shm_name)
+    _SUPPORTED = np.ndarray((size,), dtype=np.uint32, buffer=_SHARED.buf)
+
 
-    return True
+def clean_review(review: LetterboxdReview) -> Optional[LetterboxdReview]:
+    """
+    Cleans a single review inside a worker process.
+    :param review: the review to clean
+    :return: the cleaned review, or None if it should not be included in the clean set
+    """
+    if not should_include(review, _SUPPORTED):
+        return None
+
+    review['text'] = review['text'].replace(' ', ' ')
+    return review
 
 
 def main() -> None:
@@ -49,23 +122,32 @@ def main() -> None:
     parser.add_argument("-o", "--output", required=True, help="File where cleaned reviews will be stored")
     parser.add_argument("-f", "--fonts", nargs='+', required=True,
                         help="The font(s) which will be used to render the reviews")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="Number of worker processes to use (defaults to the number of CPUs)")
 
     args = parser.parse_args()
 
-    fonts = [TTFont(f) for f in args.fonts]
-
-    with open(args.input, "r") as f:
-        reviews = json.load(f)
-
-    clean_reviews = []
-    for review in reviews:
-        if should_include(review, fonts):
-            review['text'] = review['text'].replace(' ', ' ')
-            clean_reviews.append(review)
-
-    print(f"Original reviews: {len(reviews)}\nCleaned reviews: {len(clean_reviews)}")
-    with open(args.output, "w") as f:
-        json.dump(clean_reviews, f, indent=4, ensure_ascii=False)
+    shm, size = share_codepoints(supported_codepoints([TTFont(f) for f in args.fonts]))
+
+    total = 0
+    kept = 0
+    try:
+        with Pool(args.jobs, initializer=init_worker, initargs=(shm.name, size)) as pool:
+            with open(args.input, "rb") as inp, open(args.output, "wb") as out:
+                # Stream reviews through the workers rather than loading the whole file into memory
+                out.write(b'[')
+                reviews = ijson.items(inp, 'item', use_float=True)
+                for review in pool.imap(clean_review, reviews, chunksize=CHUNK_SIZE):
+                    total += 1
+                    if review is not None:
+                        out.write((b',' if kept else b'') + orjson.dumps(review))
+                        kept += 1
+                out.write(b']')
+    finally:
+        shm.close()
+        shm.unlink()
+
+    print(f"Original reviews: {total}\nCleaned reviews: {kept}")
 
 
 if __name__ == '__main__':
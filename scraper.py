@@ -1,10 +1,31 @@
-import json
-from typing import List, TypedDict
-
-import langdetect
-import requests
-from bs4 import BeautifulSoup
-from tqdm import tqdm
+import asyncio
+import re
+import sys
+import unicodedata
+from typing import List, Pattern, TypedDict
+
+import aiohttp
+import orjson
+from lingua import Language, LanguageDetectorBuilder
+from selectolax.lexbor import LexborHTMLParser
+from tqdm.asyncio import tqdm_asyncio
+
+# Maximum number of requests in flight to letterboxd at any one time
+MAX_CONNECTIONS = 20
+MAX_RETRIES = 3
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=15)
+# Responses which are worth retrying, as well as any server error
+RETRY_STATUSES = {429}
+
+# Reviews are checked against every spoken language, so unlisted languages can't be mistaken for english.
+# Low accuracy mode isn't used, as it is unreliable on the short texts typical of popular reviews
+DETECTOR = LanguageDetectorBuilder.from_all_spoken_languages().build()
+
+# Texts shorter than this can't be detected reliably, so are assumed to be english if written in latin script
+MIN_DETECT_LENGTH = 20
+
+BR_RE = re.compile(r'<br\b[^>]*>', re.IGNORECASE)
+RATED_RE = re.compile(r'\brated-(\d+)\b')
 
 # Define custom type to return reviews as JSON
 LetterboxdReview = TypedDict(
@@ -20,62 +41,146 @@ LetterboxdReview = TypedDict(
 )
 
 
-def parse_paragraphs(parent: BeautifulSoup) -> str:
+def parse_paragraphs(html: str) -> str:
     """
-    Helper class to retrieve paragraphs from a BeautifulSoup object.
-    :param parent: the BeautifulSoup object to retrieve paragraphs from
+    Helper function to retrieve paragraphs from a HTML page.
+    :param html: the HTML to retrieve paragraphs from
     :return: the text, with each paragraph separated by a newline.
     """
+    # Line breaks are replaced before parsing, so they are kept in the text of each paragraph
+    tree = LexborHTMLParser(BR_RE.sub('\n', html))
+
     paras = []
-    for para in parent.find_all('p'):
-        for br in para.find_all('br'):
-            br.replace_with('\n')
-        paras.extend(para.text.split('\n'))
+    for para in tree.css('p'):
+        paras.extend(para.text().split('\n'))
 
     return '\n'.join(paras)
 
 
-def parse_letterboxd(url: str, exclude_list: List[str]) -> List[LetterboxdReview]:
+def is_latin_script(text: str) -> bool:
+    """
+    Checks whether a piece of text contains letters, all of which are from the latin alphabet.
+    :param text: the text to check
+    :return: True if `text` contains at least one letter and no letters from other scripts, otherwise False
+    """
+    letters = [char for char in text if char.isalpha()]
+    return bool(letters) and all(unicodedata.name(char, '').startswith('LATIN') for char in letters)
+
+
+def is_english(text: str) -> bool:
+    """
+    Checks whether a piece of text is written in english.
+    :param text: the text to check
+    :return: True if `text` is detected as english, or is too short to detect but written in latin script
+             (texts with no letters, e.g. only emoji, are not english)
+    """
+    if len(text) < MIN_DETECT_LENGTH:
+        return is_latin_script(text)
+    return DETECTOR.detect_language_of(text) == Language.ENGLISH
+
+
+async def fetch(session: aiohttp.ClientSession, limit: asyncio.Semaphore, url: str) -> str:
+    """
+    Retrieves the body of a page, retrying on timeouts, dropped connections, rate limiting and server errors.
+    :param session: the session to send the request through
+    :param limit: the semaphore bounding how many requests are in flight at once
+    :param url: the URL of the page
+    :return: the text of the response
+    """
+    for attempt in range(1, MAX_RETRIES + 1):
+        delay = 2 ** attempt
+
+        # The timeout only starts once a slot is held, so queued requests can't time out before being sent
+        async with limit:
+            try:
+                async with session.get(url, timeout=REQUEST_TIMEOUT) as resp:
+                    retryable = resp.status >= 500 or resp.status in RETRY_STATUSES
+                    if not retryable or attempt == MAX_RETRIES:
+                        resp.raise_for_status()
+                        return await resp.text()
+
+                    # Wait as long as the server asks, if it says
+                    retry_after = resp.headers.get('Retry-After', '')
+                    if retry_after.isdigit():
+                        delay = max(delay, int(retry_after))
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt == MAX_RETRIES:
+                    raise
+
+        # Back off before retrying
+        await asyncio.sleep(delay)
+
+
+def compile_exclude_list(exclude_list: List[str]) -> Pattern[str]:
+    """
+    Compiles a list of phrases into a single pattern, so text can be checked for all of them in one pass.
+    :param exclude_list: a list of phrases which should be excluded from results
+    :return: a case-insensitive pattern matching any of the phrases
+    """
+    phrases = [re.escape(phrase) for phrase in exclude_list if phrase]
+    # Fall back to a pattern which never matches when there is nothing to exclude
+    return re.compile('|'.join(phrases) or r'(?!)', re.IGNORECASE)
+
+
+async def parse_letterboxd(session: aiohttp.ClientSession, limit: asyncio.Semaphore, url: str,
+                           exclude_pattern: Pattern[str]) -> List[LetterboxdReview]:
     """
     Parses all letterboxd reviews from a URL.
+    :param session: the session to send requests through
+    :param limit: the semaphore bounding how many requests are in flight at once
     :param url: the URL containing a list of letterboxd reviews (i.e. a user page, or popular reviews)
-    :param exclude_list: a list of phrases which should be excluded from results
+    :param exclude_pattern: a pattern matching phrases which should be excluded from results
     :return: a list of letterboxd reviews as JSON objects
     """
     reviews = []
 
-    soup = BeautifulSoup(requests.get(url).text, 'html.parser')
-    review_elems = soup.find('ul', class_='film-list').find_all('li')
-    for review in tqdm(review_elems, desc='Reviews on page: ', leave=False):
-        review_id = review.attrs['data-object-id']
-        text_url = f'https://letterboxd.com/s/full-text/{review_id}/'
-        full_text = parse_paragraphs(BeautifulSoup(requests.get(text_url).text, 'html.parser'))
-
-        # Used to check text for language/banned words etc.
-        check_text = full_text.lower()
-
-        try:
-            if (langdetect.detect(check_text) != 'en' or
-                    any(banned_word in check_text for banned_word in exclude_list)):
-                # Skip non-english/bad language reviews
-                continue
-        except langdetect.lang_detect_exception.LangDetectException:
-            # Handle reviews with no text
+    try:
+        page = await fetch(session, limit, url)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        # Skip the page rather than losing every other page's reviews
+        tqdm_asyncio.write(f'Skipping {url}: {type(e).__name__} {e}')
+        return reviews
+
+    review_elems = LexborHTMLParser(page).css('ul.film-list > li')
+
+    # Fetch the full text of every review on the page at once
+    text_pages = await asyncio.gather(
+        *[fetch(session, limit, f'https://letterboxd.com/s/full-text/{review.attributes["data-object-id"]}/')
+          for review in review_elems],
+        return_exceptions=True
+    )
+
+    failed = sum(isinstance(text_page, Exception) for text_page in text_pages)
+    if failed:
+        tqdm_asyncio.write(f'Skipping {failed} review(s) on {url} whose text could not be retrieved')
+
+    for review, text_page in zip(review_elems, text_pages):
+        if isinstance(text_page, Exception):
+            # Skip reviews whose text could not be retrieved
             continue
 
-        title = review.find('a')
-        title_text = title.text
-        review_link = 'https://letterboxd.com' + title.attrs['href']
+        attrs = review.attributes
+        review_id = attrs['data-object-id']
+        full_text = parse_paragraphs(text_page)
 
-        rating_elem = review.find('span', class_='rating')
-        rating = -1
+        if not full_text.strip():
+            # Skip reviews with no text
+            continue
+
+        # Check for banned words before the (slower) language check
+        if exclude_pattern.search(full_text) or not is_english(full_text):
+            # Skip bad language/non-english reviews
+            continue
 
-        if rating_elem is not None:
-            for css_class in rating_elem.attrs['class']:
-                if css_class.startswith('rated-'):
-                    rating = int(css_class.split('-')[1])
+        title = review.css_first('a')
+        title_text = title.text()
+        review_link = 'https://letterboxd.com' + title.attributes['href']
 
-        user = review.attrs['data-owner']
+        rating_elem = review.css_first('span.rating')
+        rating_match = RATED_RE.search(rating_elem.attributes['class']) if rating_elem is not None else None
+        rating = int(rating_match.group(1)) if rating_match is not None else -1
+
+        user = attrs['data-owner']
 
         reviews.append({
             'id': review_id,
@@ -89,19 +194,27 @@ def parse_letterboxd(url: str, exclude_list: List[str]) -> List[LetterboxdReview
     return reviews
 
 
-def main() -> None:
+async def main() -> None:
     with open('banned_words.txt', 'r') as f:
-        exclude_list = f.read().splitlines()
+        exclude_pattern = compile_exclude_list(f.read().splitlines())
 
-    langdetect.DetectorFactory.seed = 123
-    reviews = []
+    limit = asyncio.Semaphore(MAX_CONNECTIONS)
+    connector = aiohttp.TCPConnector(limit=MAX_CONNECTIONS)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        pages = await tqdm_asyncio.gather(
+            *[parse_letterboxd(session, limit, f'https://letterboxd.com/reviews/popular/page/{i}/',
+                               exclude_pattern)
+              for i in range(1, 257)],
+            desc="Fetching popular reviews",
+            mininterval=0.5,
+            disable=not sys.stderr.isatty()
+        )
 
-    for i in tqdm(range(1, 257), desc="Fetching popular reviews"):
-        reviews.extend(parse_letterboxd(f'https://letterboxd.com/reviews/popular/page/{i}/', exclude_list))
+    reviews = [review for page in pages for review in page]
 
-    with open('reviews.json', 'w') as f:
-        json.dump(reviews, f, indent=4, ensure_ascii=False)
+    with open('reviews.json', 'wb') as f:
+        f.write(orjson.dumps(reviews, option=orjson.OPT_INDENT_2))
 
 
 if __name__ == '__main__':
-    main()
+    asyncio.run(main())
@@ -1,11 +1,18 @@
 import argparse
-import json
 import os
+import sys
+import threading
+import time
 import traceback
-from typing import List, Dict
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Set
 
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
+from urllib3.util.retry import Retry
 
 from prisma import Prisma
 from prisma.models import Movie, Worker, Review, CrewMember
@@ -14,71 +21,113 @@ from dotenv import dotenv_values
 from urllib.parse import quote_plus
 from scraper import LetterboxdReview
 
+REVIEW_BATCH_SIZE = 500
+# Number of stored batches between each checkpoint
+CHECKPOINT_INTERVAL = 10
+OMDB_WORKERS = 16
+# Default number of seconds between OMDB requests, to stay under the free tier's rate limit
+OMDB_INTERVAL = 1.0
 
-def create_crew_for(movie: Movie, crew_list: List[str], role: str) -> None:
+# Shared by every OMDB worker, so requests are spaced out across all of them
+_OMDB_LOCK = threading.Lock()
+_last_omdb_request = 0.0
+
+# IDs of workers already stored in the database, keyed by name
+SEEN_WORKERS: Dict[str, int] = {}
+
+# Shared session so that OMDB requests reuse the same connection
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=32,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504])
+))
+
+
+def create_crew_for(movie: Movie, crew: Dict[str, str]) -> None:
     """
-    Creates CrewMember models for everybody with a given role
-    :param movie: the movie that the crew member belongs to
-    :param crew_list: a list of names to create CrewMember models for
-    :param role: the role of the crew members
+    Creates CrewMember models for everybody who worked on a movie
+    :param movie: the movie that the crew members belong to
+    :param crew: a mapping from the name of each crew member to their role(s)
     """
-    for cm in crew_list:
-        wiki_link = f'https://en.wikipedia.org/wiki/{cm.replace(" ", "_")}'
-
-        # Find or create worker
-        worker = Worker.prisma().upsert(
-            where={
-                'name': cm,
-            },
-            data={
-                'update': {},
-                'create': {
+    # Create any workers which haven't been seen yet, then look up their IDs
+    new_workers = [cm for cm in crew if cm not in SEEN_WORKERS]
+    if new_workers:
+        Worker.prisma().create_many(
+            data=[
+                {
                     'name': cm,
-                    'link': wiki_link
+                    'link': f'https://en.wikipedia.org/wiki/{cm.replace(" ", "_")}'
                 }
-            },
+                for cm in new_workers
+            ],
+            skip_duplicates=True
         )
-
-        # Find crew member
-        existing_crew = CrewMember.prisma().find_unique(
+        workers = Worker.prisma().find_many(
             where={
-                'movieId_workerId': {'movieId': movie.id, 'workerId': worker.id}
+                'name': {'in': new_workers}
             }
         )
+        SEEN_WORKERS.update((worker.name, worker.id) for worker in workers)
 
-        if existing_crew is not None:
-            new_role = existing_crew.role + f' + {role}'
-        else:
-            new_role = role
+    # Create crew member links
+    CrewMember.prisma().create_many(
+        data=[
+            {
+                'movieId': movie.id,
+                'workerId': SEEN_WORKERS[cm],
+                'role': role
+            }
+            for cm, role in crew.items()
+        ],
+        skip_duplicates=True
+    )
 
-        # Create crew member link
-        CrewMember.prisma().upsert(
-            where={
-                'movieId_workerId': {'movieId': movie.id, 'workerId': worker.id}
-            },
-            data={
-                'update': {
-                    'role': new_role
-                },
-                'create': {
-                    'movieId': movie.id,
-                    'workerId': worker.id,
-                    'role': role
-                }
-            },
-        )
+
+def wait_for_omdb(interval: float) -> None:
+    """
+    Blocks until at least `interval` seconds have passed since the last OMDB request made by any worker.
+    :param interval: the minimum number of seconds between OMDB requests
+    """
+    global _last_omdb_request
+    with _OMDB_LOCK:
+        wait = _last_omdb_request + interval - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        _last_omdb_request = time.monotonic()
 
 
-def create_movie_model(config: Dict, movie_name: str) -> Movie:
+def fetch_movie_data(config: Dict, movie_name: str, omdb_cache: Dict[str, Dict]) -> Dict:
     """
-    Collects data about a movie and creates a model.
-    :param config: the .env config containing the OMDB API key
+    Retrieves data about a movie from OMDB, using the cached response if there is one.
+    :param config: the .env config containing the OMDB API key, and optionally the minimum number of seconds
+                   (OMDB_INTERVAL) between requests
     :param movie_name: the name of the movie
-    :return: the movie model
+    :param omdb_cache: previous OMDB responses, keyed by movie name
+    :return: the OMDB response for the movie
     """
+    movie_data = omdb_cache.get(movie_name)
+    if movie_data is None:
+        wait_for_omdb(float(config.get('OMDB_INTERVAL') or OMDB_INTERVAL))
+
+        url_encoded = quote_plus(movie_name)
+        movie_data = SESSION.get(f'https://www.omdbapi.com/?t={url_encoded}&apikey={config["OMDB_KEY"]}',
+                                 timeout=10).json()
+
+        # Only cache successful lookups, so that errors (e.g. rate limiting) are retried next time
+        if movie_data.get('Response') == 'True':
+            omdb_cache.setdefault(movie_name, movie_data)
+
+    return movie_data
+
 
-    url_encoded = quote_plus(movie_name)
-    movie_data = requests.get(f'https://www.omdbapi.com/?t={url_encoded}&apikey={config["OMDB_KEY"]}').json()
+def create_movie_model(movie_name: str, movie_data: Dict) -> Movie:
+    """
+    Creates a model for a movie.
+    :param movie_name: the name of the movie
+    :param movie_data: the OMDB response for the movie
+    :return: the movie model
+    """
     movie = Movie.prisma().create(
         data={
             'id': movie_data['imdbID'],
@@ -90,46 +139,68 @@ def create_movie_model(config: Dict, movie_name: str) -> Movie:
         }
     )
 
-    actors = movie_data['Actors'].split(', ')
-    directors = movie_data['Director'].split(', ')
+    # Combine roles for anybody who is both an actor and a director
+    crew = {}
+    for role, names in (('Actor', movie_data['Actors']), ('Director', movie_data['Director'])):
+        for cm in names.split(', '):
+            crew[cm] = f'{crew[cm]} + {role}' if cm in crew else role
 
-    create_crew_for(movie, actors, 'Actor')
-    create_crew_for(movie, directors, 'Director')
+    create_crew_for(movie, crew)
 
     return movie
 
 
-def create_review_model(review: LetterboxdReview, movie_id: str):
+def parse_review_id(review: LetterboxdReview) -> int:
+    """
+    Retrieves the numeric ID of a review
+    :param review: the review
+    :return: the ID of the review, as used by the review model
+    """
+    return int(review['id'].replace('viewing:', ''))
+
+
+def review_data(review: LetterboxdReview, movie_id: str) -> Dict:
     """
-    Creates and stores a model for a given review
+    Builds the data for a review model
     :param review: the review to create a model for
     :param movie_id: the ID of the movie to which the review belongs
-    :return:
+    :return: the data to create the review model with
     """
-    review_id = int(review['id'].replace('viewing:', ''))
+    return {
+        'id': parse_review_id(review),
+        'movieId': movie_id,
+        'reviewer': review['user'],
+        'link': review['link'],
+        'text': review['text'],
+        'rating': review['rating']
+    }
 
-    Review.prisma().upsert(
-        where={
-            'id': review_id
-        },
-        data={
-            'update': {
-                'id': review_id,
-                'reviewer': review['user'],
-                'link': review['link'],
-                'text': review['text'],
-                'rating': review['rating']
-            },
-            'create': {
-                'id': review_id,
-                'movieId': movie_id,
-                'reviewer': review['user'],
-                'link': review['link'],
-                'text': review['text'],
-                'rating': review['rating']
-            }
-        },
-    )
+
+def create_review_models(batch: List[Dict], processed: Set[int]) -> None:
+    """
+    Stores a batch of review models, skipping any reviews which are already stored
+    :param batch: the data for each review model, as built by review_data
+    :param processed: the IDs of stored reviews, which the batch is added to once stored
+    """
+    Review.prisma().create_many(data=batch, skip_duplicates=True)
+    processed.update(data['id'] for data in batch)
+
+
+def save_checkpoint(movies: Dict[str, str], omdb_cache: Dict[str, Dict], processed: Set[int]) -> None:
+    """
+    Writes current progress to file, so that a later run can resume from it
+    :param movies: the IDs of stored movies, keyed by lowercase title
+    :param omdb_cache: previous OMDB responses, keyed by movie name
+    :param processed: the IDs of stored reviews
+    """
+    with open('movies.json', 'wb') as f:
+        f.write(orjson.dumps(movies, option=orjson.OPT_INDENT_2))
+    with open('omdb_cache.json', 'wb') as f:
+        f.write(orjson.dumps(omdb_cache, option=orjson.OPT_INDENT_2))
+    with open('workers.json', 'wb') as f:
+        f.write(orjson.dumps(SEEN_WORKERS, option=orjson.OPT_INDENT_2))
+    with open('processed_ids.json', 'wb') as f:
+        f.write(orjson.dumps(sorted(processed)))
 
 
 def main(config: Dict) -> None:
@@ -144,38 +215,103 @@ def main(config: Dict) -> None:
 
     args = parser.parse_args()
     # Load cached reviews
-    with open(args.review_file, 'r') as f:
-        reviews = json.load(f)
+    with open(args.review_file, 'rb') as f:
+        reviews = orjson.loads(f.read())
 
     # Load cached film IDs
     if os.path.exists("movies.json"):
-        with open('movies.json', 'r') as f:
-            movies = json.load(f)
+        with open('movies.json', 'rb') as f:
+            movies = orjson.loads(f.read())
     else:
         movies = {}
 
+    # Load cached OMDB responses
+    if os.path.exists("omdb_cache.json"):
+        with open('omdb_cache.json', 'rb') as f:
+            omdb_cache = orjson.loads(f.read())
+    else:
+        omdb_cache = {}
+
+    # Load cached worker IDs
+    if os.path.exists("workers.json"):
+        with open('workers.json', 'rb') as f:
+            SEEN_WORKERS.update(orjson.loads(f.read()))
+
+    # Load IDs of reviews stored by previous runs
+    if os.path.exists("processed_ids.json"):
+        with open('processed_ids.json', 'rb') as f:
+            processed = set(orjson.loads(f.read()))
+    else:
+        processed = set()
+
     # Connect to postgres DB
     db = Prisma(auto_register=True)
     db.connect()
+
+    # Group reviews which haven't been stored yet by movie, so that each movie is only looked up once
+    movie_reviews = defaultdict(list)
+    remaining = 0
+    for review in reviews:
+        if parse_review_id(review) not in processed:
+            movie_reviews[review['movie'].lower()].append(review)
+            remaining += 1
+
+    # Prefetch OMDB data for movies which aren't stored yet, so lookups overlap with database writes
+    executor = ThreadPoolExecutor(OMDB_WORKERS)
+    movie_data_futures = {
+        key: executor.submit(fetch_movie_data, config, grouped[0]['movie'], omdb_cache)
+        for key, grouped in movie_reviews.items() if key not in movies
+    }
+
     crash_movie = ""
+    pending_reviews = []
+    batches = 0
+    # Progress is updated once per stored batch, rather than for every review
+    pbar = tqdm(total=remaining, desc='Building models', mininterval=0.5, disable=not sys.stderr.isatty())
     try:
-        for review in tqdm(reviews, desc='Building models'):
-            if movies.get(review['movie'].lower()) is None:
-                crash_movie = review['movie']
-                movie_id = create_movie_model(config, review['movie']).id
-                movies[review['movie'].lower()] = movie_id
-            else:
-                movie_id = movies[review['movie'].lower()]
-
-            create_review_model(review, movie_id)
+        for key, grouped in movie_reviews.items():
+            movie_id = movies.get(key)
+            if movie_id is None:
+                crash_movie = grouped[0]['movie']
+                try:
+                    movie_data = movie_data_futures[key].result()
+                except (requests.RequestException, ValueError) as e:
+                    movie_data = {'Error': f'{type(e).__name__} {e}'}
+
+                if movie_data.get('Response') != 'True':
+                    # Skip the movie's reviews, which will be retried on the next run
+                    tqdm.write(f"Skipping {crash_movie}: {movie_data.get('Error', 'OMDB lookup failed')}")
+                    continue
+
+                movie_id = create_movie_model(crash_movie, movie_data).id
+                movies[key] = movie_id
+
+            pending_reviews.extend(review_data(review, movie_id) for review in grouped)
+            if len(pending_reviews) >= REVIEW_BATCH_SIZE:
+                create_review_models(pending_reviews, processed)
+                pbar.update(len(pending_reviews))
+                pending_reviews.clear()
+
+                batches += 1
+                if batches % CHECKPOINT_INTERVAL == 0:
+                    save_checkpoint(movies, omdb_cache, processed)
+
+        if pending_reviews:
+            create_review_models(pending_reviews, processed)
+            pbar.update(len(pending_reviews))
     except Exception as e:
         print(f"Crashed on {crash_movie}")
         traceback.print_exc()
+    finally:
+        # Also runs on Ctrl-C, so progress is never lost
+        pbar.close()
+
+        # Don't wait for lookups which haven't started yet
+        executor.shutdown(cancel_futures=True)
 
-    # Close connection and write current movies to file in case of failure
-    db.disconnect()
-    with open('movies.json', 'w') as f:
-        json.dump(movies, f, indent=4, ensure_ascii=False)
+        # Close connection and write current progress to file in case of failure
+        db.disconnect()
+        save_checkpoint(movies, omdb_cache, processed)
 
 
 if __name__ == '__main__':